@@ -1,23 +1,54 @@
 #!/usr/bin/env python3
 
+import io
 import os
-import json
+import re
+import sys
 import time
+import pickle
+import sqlite3
+import asyncio
+import aiohttp
 import shutil
+import zipfile
 import tempfile
 import argparse
+import threading
 import requests
 import datetime
+import functools
 import dataclasses
-import pkg_resources
+import concurrent.futures
+import platformdirs
 
-from bs4 import BeautifulSoup
+from collections        import defaultdict
+from importlib.metadata import version as package_version
+from bs4                import BeautifulSoup
+from bs4.filter         import ElementFilter
+from requests.adapters  import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
 
-VERSION      = pkg_resources.get_distribution("gsout").version
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json   import loads as json_loads
+
+
+VERSION      = package_version("gsout")
 BASE_URL     = "https://www.gradescope.com"
+UPLOADS_URL  = "https://production-gradescope-uploads"
 USER_AGENT   = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36"
 SEASON_ORDER = {'Spring': 0, 'Summer': 1, 'Fall': 2}
+TERM_REGEX   = re.compile(r'^(Spring|Summer|Fall)\s+(\d{4})$')
+CONCURRENCY  = 16
+COPY_BUFSIZE = 1 << 20
+SPOOL_SIZE   = 8 << 20
+CACHE_SCHEMA = 2
 
 
 parser = argparse.ArgumentParser(
@@ -48,24 +79,143 @@ parser.add_argument(
     help="Path of the ZIP archive file to create.",
     required=True,
 )
+parser.add_argument(
+    "--no-cache", action="store_true",
+    help="Neither read nor update the cache of scraped course pages.",
+)
+
+args         = parser.parse_args()
+semaphore    = asyncio.Semaphore(CONCURRENCY)
+thread_local = threading.local()
+zip_lock     = threading.Lock()
+
+
+def new_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.setdefault("User-Agent",   USER_AGENT)
+    session.cookies.set("_gradescope_session", args.session)
+    session.cookies.set("signed_token",        args.token)
+    session.mount("https://", HTTPAdapter(
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    ))
+
+    return session
+
+
+def thread_session() -> requests.Session:
+    if not hasattr(thread_local, "session"):
+        thread_local.session = new_session()
+
+    return thread_local.session
+
+
+def new_client() -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        headers={"User-Agent": USER_AGENT},
+        cookies={
+            "_gradescope_session": args.session,
+            "signed_token":        args.token,
+        },
+    )
+
+
+class PageCache:
+    def __init__(self, path: str | None):
+        self.db = None
+        if path is None:
+            return
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (url TEXT PRIMARY KEY, schema INTEGER, etag TEXT, last_modified TEXT, value BLOB)")
+
+    def lookup(self, url: str) -> tuple[dict[str, str], object]:
+        if self.db is None:
+            return {}, None
+
+        row = self.db.execute("SELECT etag, last_modified, value FROM entries WHERE url = ? AND schema = ?", (url, CACHE_SCHEMA)).fetchone()
+        if row is None:
+            return {}, None
+
+        etag, last_modified, value = row
+        try:
+            value = pickle.loads(value)
+        except Exception as e:
+            print(f"Warning: Ignoring unreadable cache entry for {url}. (See: {e})")
+            return {}, None
 
-args    = parser.parse_args()
-session = requests.Session()
-session.headers.setdefault("User-Agent",   USER_AGENT)
-session.cookies.set("_gradescope_session", args.session)
-session.cookies.set("signed_token",        args.token)
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
 
+        return headers, value
 
-def list_courses() -> set[str]:
-    results  = set()
-    response = session.get(f"{BASE_URL}")
-    webpage  = BeautifulSoup(response.text, 'html.parser')
-    for class_link in webpage.find_all('a', class_='courseBox'):
-        results.add(class_link['href'].split('/')[-1].strip())
+    def store(self, url: str, response: aiohttp.ClientResponse, value: object):
+        if self.db is None or response.status != 200:
+            return
+
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (url, CACHE_SCHEMA, etag, last_modified, pickle.dumps(value)),
+            )
+
+
+cache = PageCache(None if args.no_cache else os.path.join(
+    platformdirs.user_cache_dir("gsout", ensure_exists=True), "cache.sqlite"
+))
+
+
+async def list_courses(client: aiohttp.ClientSession) -> set[str]:
+    url              = f"{BASE_URL}"
+    headers, results = cache.lookup(url)
+    async with semaphore, client.get(url, headers=headers) as response:
+        if response.status == 304 and results is not None:
+            return results
+        content = await response.read()
+
+    results = set()
+
+    if LexborHTMLParser is not None:
+        links = [_.attributes['href'] for _ in LexborHTMLParser(content).css('a.courseBox')]
+    else:
+        links = [_['href'] for _ in BeautifulSoup(content, 'lxml').find_all('a', class_='courseBox')]
+
+    for link in links:
+        results.add(link.split('/')[-1].strip())
+
+    cache.store(url, response, results)
 
     return results
 
 
+COURSE_FIELDS = {
+    ('div', 'sidebar--title-course'),
+    ('div', 'sidebar--subtitle'),
+    ('h2',  'courseHeader--term'),
+    ('ul',  'js-sidebarRoster'),
+}
+
+
+class CoursePageFilter(ElementFilter):
+    TABLE_ID = 'assignments-student-table'
+    CLASSES  = {class_ for _, class_ in COURSE_FIELDS}
+
+    def allow_tag_creation(self, nsprefix, name, attrs) -> bool:
+        if attrs is None:
+            return False
+
+        return attrs.get('id') == self.TABLE_ID or not self.CLASSES.isdisjoint(attrs.get('class', '').split())
+
+    def allow_string_creation(self, string) -> bool:
+        return False
+
+
 @dataclasses.dataclass
 class InspectedAssignmentFromCourse:
     slug:       str
@@ -80,39 +230,114 @@ class InspectedCourse:
     short_name:  str
     long_name:   str
     term:        str
-    instructors: set[str]
-    assignments: set[InspectedAssignmentFromCourse]
+    instructors: tuple[str, ...]
+    assignments: tuple[InspectedAssignmentFromCourse, ...]
+
+    def __post_init__(self):
+        self.slug        = sys.intern(self.slug)
+        self.term        = sys.intern(self.term)
+        self.instructors = tuple(sys.intern(_) for _ in self.instructors)
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.__post_init__()
+
 
+async def inspect_course(client: aiohttp.ClientSession, slug: str) -> InspectedCourse:
+    url             = f"{BASE_URL}/courses/{slug}"
+    headers, course = cache.lookup(url)
+    async with semaphore, client.get(url, headers=headers) as response:
+        if response.status == 304 and course is not None:
+            return course
+        content = await response.read()
 
-def inspect_course(slug: str) -> InspectedCourse:
-    response = session.get(f"{BASE_URL}/courses/{slug}")
-    webpage  = BeautifulSoup(response.text, 'html.parser')
+    if LexborHTMLParser is not None:
+        course = parse_course_lexbor(slug, content)
+    else:
+        course = parse_course_soup(slug, content)
+
+    cache.store(url, response, course)
+
+    return course
+
+
+def parse_course_lexbor(slug: str, content: bytes) -> InspectedCourse:
+    webpage = LexborHTMLParser(content)
+
+    assignments = []
+    for row in webpage.css('table#assignments-student-table tr'):
+        link  = row.css_first('a')
+        score = row.css_first('div.submissionStatus--score')
+        if link is None or score is None:
+            continue
+        href = link.attributes['href'].split('/')
+        assignments.append(
+            InspectedAssignmentFromCourse(
+                slug=href[-3].strip(),
+                name=link.text().strip(),
+                grade=score.text().strip(),
+                submission=href[-1].strip()
+            )
+        )
+
+    fields = {}
+    for node in webpage.css(', '.join(f'{name}.{class_}' for name, class_ in COURSE_FIELDS)):
+        for class_ in (node.attributes.get('class') or '').split():
+            if (node.tag, class_) in COURSE_FIELDS:
+                fields.setdefault((node.tag, class_), node)
+
+    return InspectedCourse(
+        slug        = slug,
+        short_name  = fields[('div', 'sidebar--title-course')].text().strip(),
+        long_name   = fields[('div', 'sidebar--subtitle')].text().strip(),
+        term        = fields[('h2', 'courseHeader--term')].text().strip(),
+        instructors = tuple(dict.fromkeys(
+            _.text().strip()
+            for _ in fields[('ul', 'js-sidebarRoster')].css('li')
+        )),
+        assignments = tuple(assignments),
+    )
+
+
+def parse_course_soup(slug: str, content: bytes) -> InspectedCourse:
+    webpage = BeautifulSoup(content, 'lxml', parse_only=CoursePageFilter())
+
+    table = webpage.find('table', id='assignments-student-table')
 
     assignments = []
-    for row in webpage.find('table', id='assignments-student-table').find_all('tr'):
-        if row.find('a') is None:
+    for row in table.find_all('tr'):
+        link = row.find('a')
+        if link is None:
             continue
-        if row.find('div', class_='submissionStatus--score') is None:
+        score = row.find('div', class_='submissionStatus--score')
+        if score is None:
             continue
+        href = link['href'].split('/')
         assignments.append(
             InspectedAssignmentFromCourse(
-                slug=row.find('a')['href'].split('/')[-3].strip(),
-                name=row.find('a').text.strip(),
-                grade=row.find('div', class_='submissionStatus--score').text.strip(),
-                submission=row.find('a')['href'].split('/')[-1].strip()
+                slug=href[-3].strip(),
+                name=link.text.strip(),
+                grade=score.text.strip(),
+                submission=href[-1].strip()
             )
         )
 
+    fields = {}
+    for node in webpage.find_all([name for name, _ in COURSE_FIELDS], class_=list(CoursePageFilter.CLASSES)):
+        for class_ in node.get('class', []):
+            if (node.name, class_) in COURSE_FIELDS:
+                fields.setdefault((node.name, class_), node)
+
     return InspectedCourse(
         slug        = slug,
-        short_name  = webpage.find('div', class_='sidebar--title-course').text.strip(),
-        long_name   = webpage.find('div', class_='sidebar--subtitle').text.strip(),
-        term        = webpage.find('h2',  class_='courseHeader--term').text.strip(),
-        instructors = list({
+        short_name  = fields[('div', 'sidebar--title-course')].text.strip(),
+        long_name   = fields[('div', 'sidebar--subtitle')].text.strip(),
+        term        = fields[('h2', 'courseHeader--term')].text.strip(),
+        instructors = tuple(dict.fromkeys(
             _.text.strip()
-            for _ in webpage.find('ul', class_='js-sidebarRoster').find_all('li')
-        }),
-        assignments = assignments,
+            for _ in fields[('ul', 'js-sidebarRoster')].find_all('li')
+        )),
+        assignments = tuple(assignments),
     )
 
 
@@ -128,7 +353,7 @@ class InspectedSubmission:
     files: list[SubmissionFile]
 
 
-def list_submissions(course: InspectedCourse, assignment: InspectedAssignmentFromCourse) -> list[InspectedSubmission]:
+async def list_submissions(client: aiohttp.ClientSession, course: InspectedCourse, assignment: InspectedAssignmentFromCourse) -> list[InspectedSubmission]:
     # TODO: Scrape the list of submissions.
 
     files = []
@@ -139,15 +364,17 @@ def list_submissions(course: InspectedCourse, assignment: InspectedAssignmentFro
         ))
 
     try:
-        response = session.get(f"{BASE_URL}/courses/{course.slug}/assignments/{assignment.slug}/submissions/{assignment.submission}")
-        
-        try:
-            data = json.loads(response.text)
-            link = data["pdf_attachment"]["url"]
-        except:
-            link = ('https://production-gradescope-uploads' + ''.join(response.text.split("https://production-gradescope-uploads")[1:])).split("&quot")[0]
+        async with semaphore, client.get(f"{BASE_URL}/courses/{course.slug}/assignments/{assignment.slug}/submissions/{assignment.submission}") as response:
+            content = await response.read()
+
+        if "json" in response.content_type:
+            attachment = json_loads(content).get("pdf_attachment") or {}
+            link       = attachment.get("url") or ""
+        else:
+            _, found, rest = content.decode(errors="replace").partition(UPLOADS_URL)
+            link = UPLOADS_URL + rest.partition("&quot")[0] if found else ""
 
-        if "pdf" in link:        
+        if "pdf" in link:
             files.append(SubmissionFile(
                 url=link,
                 ext="pdf",
@@ -168,56 +395,105 @@ class DownloadedFile:
     ext:   str
 
 
-def download(out_dir: str, course: str, assignment: str, submission: InspectedSubmission) -> list[DownloadedFile]:
-    filenames = []
-    for index, link in enumerate(submission.files):
-        try:
-            filename = f"{course}-{assignment}-{submission.slug}-{index + 1}.{link.ext}"
-            response = session.get(link.url, stream=True)
-            if response.status_code != 200:
-                continue
-
-            with open(os.path.join(out_dir, filename), 'wb') as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
-
-            filenames.append(DownloadedFile(
-                index=index + 1,
-                path=filename,
-                ext=link.ext,
-            ))
-        except Exception as e:
-            print(e)
+def zip_entry(filename: str) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+    info.external_attr = 0o644 << 16
 
-    return filenames
+    return info
+
+
+def download(archive: zipfile.ZipFile, course: str, assignment: str, submission: str, index: int, link: SubmissionFile) -> DownloadedFile | None:
+    try:
+        filename = f"{course}-{assignment}-{submission}-{index + 1}.{link.ext}"
+        response = thread_session().get(link.url, stream=True)
+        if response.status_code != 200:
+            response.close()
+            return None
+
+        response.raw.decode_content = True
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            shutil.copyfileobj(response.raw, spool, length=COPY_BUFSIZE)
+            spool.seek(0)
+
+            with zip_lock, archive.open(zip_entry(filename), 'w', force_zip64=True) as file:
+                shutil.copyfileobj(spool, file, length=COPY_BUFSIZE)
+
+        return DownloadedFile(
+            index=index + 1,
+            path=filename,
+            ext=link.ext,
+        )
+    except Exception as e:
+        print(e)
+
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def term_chrono_index(term: str) -> tuple[int, int]:
+    match = TERM_REGEX.match(term)
+    if match is None:
+        print(f"Warning: Cannot sort term {term!r}.")
+        return (0, 0)
+
+    return (int(match.group(2)), SEASON_ORDER[match.group(1)])
 
 
 def sort_courses(courses: list[InspectedCourse]) -> list[tuple[str,list[InspectedCourse]]]:
-    by_term: dict = {}
+    by_term = defaultdict(list)
     for course in courses:
-        by_term[course.term] = by_term.get(course.term, []) + [course]
+        by_term[course.term].append(course)
 
-    def term_chrono_index(term):
-        try:
-            season, year = term.split()
-            return (int(year), SEASON_ORDER[season])
-        except Exception as e:
-            print(f"Warning: Cannot sort terms. (See: {e})")
+    return sorted(by_term.items(), key=lambda _: term_chrono_index(_[0]))
 
-        return (0, 0)
 
-    return [
-        (term, list(courses))
-        for term, courses in sorted(by_term.items(), key=lambda _: term_chrono_index(_[0]))
-    ]
+async def scrape() -> tuple[list[InspectedCourse], dict[tuple[str, str], list[InspectedSubmission]]]:
+    async with new_client() as client:
+        print("Inspecting courses:")
+        course_slugs = [sys.intern(_) for _ in await list_courses(client)]
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(inspect_course(client, slug)) for slug in course_slugs]
+
+        courses, n_courses = [], len(course_slugs)
+        width = len(str(n_courses))
+        for i, task in enumerate(tasks):
+            course = task.result()
+            print(f"[{i + 1:0{width}d}/{n_courses}] {len(course.assignments):03d} A & {len(course.instructors):03d} I. {course.short_name}.")
+            courses.append(course)
+
+        print("\nListing submissions...")
+        async with asyncio.TaskGroup() as tg:
+            tasks = {
+                (course.slug, assignment.slug): tg.create_task(list_submissions(client, course, assignment))
+                for course in courses for assignment in course.assignments
+            }
+
+    return courses, { key: task.result() for key, task in tasks.items() }
 
 
 def main():
     print(f" henryleberre/gsout version {VERSION}\n")
 
-    with tempfile.TemporaryDirectory(delete=False) as tmpdir:
-        with open(os.path.join(tmpdir, "README.md"), "w") as readme:
-            readme.write(f"""\
+    courses, all_submissions = asyncio.run(scrape())
+
+    with zipfile.ZipFile(f"{args.output}.zip", 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        print("\nDownloading submissions...")
+        jobs = [
+            (archive, course.slug, assignment.slug, submission.slug, index, file)
+            for course     in courses
+            for assignment in course.assignments
+            for submission in all_submissions[(course.slug, assignment.slug)]
+            for index, file in enumerate(submission.files)
+        ]
+
+        downloads: dict[tuple[str, str, str], list[DownloadedFile]] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+            for job, file in zip(jobs, executor.map(lambda job: download(*job), jobs)):
+                if file is not None:
+                    downloads.setdefault(job[1:4], []).append(file)
+
+        readme = io.StringIO()
+        readme.write(f"""\
 # Gradescope Submissions
 
 [henryleberre/gsout](https://github.com/henryleberre/gsout) version {VERSION}
@@ -225,52 +501,47 @@ exported your gradescope submissions on {datetime.datetime.now().strftime("%Y-%m
 
 """)
 
-            print("Inspecting courses:")
-            courses, course_slugs = [], list_courses()
-            for i, slug in enumerate(course_slugs):
-                course = inspect_course(slug)
-                print(f"[{str(i + 1).zfill(len(str(len(course_slugs))))}/{len(course_slugs)}] {len(course.assignments):03d} A & {len(course.instructors):03d} I. {course.short_name}.")
-                courses.append(course)
-
-            i_assignment  = 1
-            n_assignments = sum([len(course.assignments) for course in courses])
+        i_assignment  = 1
+        n_assignments = sum([len(course.assignments) for course in courses])
+        width         = len(str(n_assignments))
 
-            print("\nDownloading submissions:")
-            for term, courses_ in sort_courses(courses):
-                readme.write(f"## {term}\n\n""")
+        print("\nSubmissions:")
+        for term, courses_ in sort_courses(courses):
+            readme.write(f"## {term}\n\n""")
 
-                for course in courses_:
-                    readme.write(f"""\
+            for course in courses_:
+                instructors = '\n'.join(f'- {r}' for r in sorted(course.instructors))
+                readme.write(f"""\
 ### [{course.short_name}]({BASE_URL}/courses/{course.slug}): {course.long_name}
 
 **Instructors:**
 
-{'\n'.join([f'- {r}' for r in course.instructors])}
+{instructors}
 
 **Assignments:**
 """)
 
-                    for assignment in course.assignments:
-                        print(f"[{str(i_assignment).zfill(len(str(n_assignments)))}/{n_assignments}] {course.short_name}: {assignment.name} ({assignment.grade})")
+                for assignment in course.assignments:
+                    print(f"[{i_assignment:0{width}d}/{n_assignments}] {course.short_name}: {assignment.name} ({assignment.grade})")
 
-                        readme.write(f"- {assignment.name} ({assignment.grade})\n")
+                    readme.write(f"- {assignment.name} ({assignment.grade})\n")
 
-                        submissions = list_submissions(course, assignment)
-                        for i, submission in enumerate(submissions):
-                            print(f"> [{str(i + 1).zfill(len(str(len(submissions))))}/{len(submissions)}] Submission {submission.slug}")
+                    submissions = all_submissions[(course.slug, assignment.slug)]
+                    for i, submission in enumerate(submissions):
+                        print(f"> [{i + 1:0{len(str(len(submissions)))}d}/{len(submissions)}] Submission {submission.slug}")
  
-                            files = download(tmpdir, course.slug, assignment.slug, submission)
-                            print(f"  {len(files)} file(s) downloaded.")
+                        files = downloads.get((course.slug, assignment.slug, submission.slug), [])
+                        print(f"  {len(files)} file(s) downloaded.")
 
-                            if len(files) == 0:
-                                readme.write(f"  * Submission: {submission.slug} (no files)\n")
-                            else:
-                                readme.write(f"  * Submission: {submission.slug} ")
+                        if len(files) == 0:
+                            parts = [f"  * Submission: {submission.slug} (no files)\n"]
+                        else:
+                            parts = [f"  * Submission: {submission.slug} "]
 
-                            for file in files:
-                                readme.write(f"[{file.ext}-{file.index}]({file.path}) ")
-                            readme.write("\n")
+                        parts.extend(f"[{file.ext}-{file.index}]({file.path}) " for file in files)
+                        parts.append("\n")
+                        readme.write(''.join(parts))
 
-                            i_assignment += 1
+                        i_assignment += 1
 
-        shutil.make_archive(args.output, 'zip', tmpdir)
+        archive.writestr(zip_entry("README.md"), readme.getvalue())